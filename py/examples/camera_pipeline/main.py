@@ -12,112 +12,319 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any
+from typing import Callable
+from typing import Optional
+from typing import Union
 
 import cv2
+import grpc
 import kornia as K
 import numpy as np
+import torch
+import torch.nn.functional as F
+import uvloop
 from farm_ng.oak.camera_client import OakCameraClient
-#from farm_ng.oak.camera_client import OakCameraClientConfig
+from farm_ng.service.service_client import ClientConfig
 from limbus.core import Component
 from limbus.core import ComponentState
-from limbus.core import Params
+from limbus.core import InputParams
+from limbus.core import OutputParams
 from limbus.core import Pipeline
+from turbojpeg import TJPF_BGR
+from turbojpeg import TurboJPEG
 
+try:
+    # optional: decode the jpeg frames on the GPU
+    from nvidia import nvimgcodec
+except ImportError:
+    nvimgcodec = None
+
+try:
+    # optional: decode the jpeg frames on the GPU with torchvision if nvimgcodec is not available
+    from torchvision.io import decode_jpeg
+except ImportError:
+    decode_jpeg = None
+
+
+class ThreadedComponent(Component):
+    """Component with a dedicated worker thread to run its CPU heavy work.
+
+    The event loop only moves data between the components, so the work of the different stages runs in
+    parallel while each stage still processes its frames in order.
+    """
 
-class AmigaCamera(Component):
     def __init__(self, name: str):
+        super().__init__(name)
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=name)
+
+    async def run_in_executor(self, func: Callable[..., Any], *args: Any) -> Any:
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+
+class AmigaCamera(ThreadedComponent):
+    def __init__(self, name: str, threaded_stream: bool = True):
         super().__init__(name)
         # configure the camera client
-        self.config = OakCameraClientConfig(address="192.168.1.93", port=50051)
+        self.config = ClientConfig(address="192.168.1.93", port=50051)
         self.client = OakCameraClient(self.config)
 
+        # the threaded stream reads the frames off the event loop, the async stream is the fallback.
+        self._threaded_stream = threaded_stream
         self.stream = None
+        # the most recent frame of the stream: when the pipeline is slower than the camera the older frames are
+        # dropped instead of queueing up, which keeps the latency bounded.
+        # the stream errors and its end (grpc.aio.EOF) go through the same slot.
+        self._latest_frame: asyncio.Queue = asyncio.Queue(maxsize=1)
+        self._reader: Optional[asyncio.Task] = None
+
+        # jpeg decoder and preallocated frame buffers, reused across frames.
+        # NOTE: the image sent downstream aliases one of these buffers, so we keep two of them
+        # to avoid overwriting a frame that is still being consumed.
+        self._jpeg = TurboJPEG()
+        self._frame_bufs = []
+        self._frame_idx = 0
+
+        # when available, decode on the GPU and send the image as a cuda tensor
+        self._decoder = None
+        if nvimgcodec is not None and torch.cuda.is_available():
+            self._decoder = nvimgcodec.Decoder()
+        self._use_cuda: bool = self._decoder is not None or (decode_jpeg is not None and torch.cuda.is_available())
 
     @staticmethod
-    def register_outputs():
-        outputs = Params()
-        outputs.declare("img")
-        return outputs
+    def register_outputs(outputs: OutputParams) -> None:
+        outputs.declare("img", Union[np.ndarray, torch.Tensor])
+
+    def _next_frame_buf(self, image_data: Union[bytes, memoryview]) -> np.ndarray:
+        width, height, _, _ = self._jpeg.decode_header(image_data)
+        shape = (height, width, 3)
+        if not self._frame_bufs or self._frame_bufs[0].shape != shape:
+            self._frame_bufs = [np.empty(shape, dtype=np.uint8) for _ in range(2)]
+        self._frame_idx = (self._frame_idx + 1) % len(self._frame_bufs)
+        return self._frame_bufs[self._frame_idx]
 
-    async def forward(self):
+    def _decode_image(self, image_data: Union[bytes, memoryview]) -> np.ndarray:
+        return self._jpeg.decode(image_data, pixel_format=TJPF_BGR, dst=self._next_frame_buf(image_data))
+
+    def _decode_image_cuda(self, image_data: Union[bytes, memoryview]) -> torch.Tensor:
+        if self._decoder is not None:
+            # nvimgcodec returns a HxWx3 RGB device image, convert it to a 3xHxW BGR tensor as in `K.image_to_tensor`
+            nv_img = self._decoder.decode(np.frombuffer(image_data, dtype=np.uint8))
+            return torch.as_tensor(nv_img, device="cuda").permute(2, 0, 1).flip(0)
+        # torchvision returns a 3xHxW RGB device tensor
+        return decode_jpeg(torch.frombuffer(image_data, dtype=torch.uint8), device="cuda").flip(0)
+
+    def _put_latest(self, item: Any) -> None:
+        if self._latest_frame.full():
+            self._latest_frame.get_nowait()
+        self._latest_frame.put_nowait(item)
+
+    async def _read_stream(self) -> None:
+        try:
+            while True:
+                response = await self.stream.read()
+                if response is grpc.aio.EOF:
+                    # let `forward` stop the component at the end of the stream
+                    self._put_latest(grpc.aio.EOF)
+                    return
+                self._put_latest(response.frame)
+        except Exception as e:
+            # hand the stream errors to `forward`, which may already be waiting for the next frame
+            self._put_latest(e)
+
+    def _stop_stream(self) -> None:
+        if self._reader is not None:
+            self._reader.cancel()
+        if self.stream is not None:
+            self.stream.cancel()
+
+    async def forward(self) -> ComponentState:
+        try:
+            state: ComponentState = await self._forward()
+        except BaseException:
+            # stop the stream when the camera fails or the pipeline is cancelled, the threaded stream keeps
+            # reading otherwise
+            self._stop_stream()
+            raise
+        if state == ComponentState.STOPPED:
+            self._stop_stream()
+        return state
+
+    async def _forward(self) -> ComponentState:
         if self.stream is None:
-            self.stream = self.client.stream_frames(every_n=10)
+            if self._threaded_stream:
+                self.stream = self.client.stream_frames_threaded(every_n=10)
+            else:
+                self.stream = self.client.stream_frames(every_n=10)
+            self._reader = asyncio.create_task(self._read_stream())
 
-        response = await self.stream.read()
-        frame = response.frame
+        frame = await self._latest_frame.get()
+        if isinstance(frame, Exception):
+            # propagate the stream errors
+            raise frame
+        if frame is grpc.aio.EOF:
+            return ComponentState.STOPPED
 
-        data: bytes = getattr(frame, "rgb").image_data
+        # hand a view of the jpeg payload to the decoder, no intermediate buffer is created
+        data = memoryview(frame.rgb.image_data)
 
-        # use imdecode function
-        image = np.frombuffer(data, dtype="uint8")
-        image = cv2.imdecode(image, cv2.IMREAD_COLOR)
+        # decode in the worker thread so that the event loop keeps serving the other components
+        decode = self._decode_image_cuda if self._use_cuda else self._decode_image
+        image: Union[np.ndarray, torch.Tensor] = await self.run_in_executor(decode, data)
 
-        self.outputs.set_param("img", image)
+        await self.outputs.img.send(image)
         return ComponentState.OK
 
 
 class OpencvWindow(Component):
+    def __init__(self, name: str):
+        super().__init__(name)
+        cv2.namedWindow(self.name, cv2.WINDOW_NORMAL)
+
+    @staticmethod
+    def register_inputs(inputs: InputParams) -> None:
+        inputs.declare("img", Union[np.ndarray, torch.Tensor])
+
+    async def forward(self) -> ComponentState:
+        img = await self.inputs.img.receive()
+        if isinstance(img, torch.Tensor):
+            img = K.tensor_to_image(img)
+        # a batch of images is shown frame by frame
+        frames = img if img.ndim == 4 else img[None]
+        for frame in frames:
+            cv2.imshow(self.name, frame)
+            cv2.waitKey(1)
+        return ComponentState.OK
+
+
+class BatchAccumulator(Component):
+    """Stack `batch_size` consecutive images into a single Nx3xHxW uint8 tensor.
+
+    The images are copied into the batch as they arrive, so the upstream frame buffers can be reused.
+    """
+
+    def __init__(self, name: str, batch_size: int):
+        super().__init__(name)
+        self.batch_size = batch_size
+
     @staticmethod
-    def register_inputs():
-        inputs = Params()
-        inputs.declare("img")
-        return inputs
-
-    async def forward(self):
-        img = self.inputs.get_param("img")
-        cv2.imshow(f"{self.name}", img)
-        cv2.waitKey(1)
+    def register_inputs(inputs: InputParams) -> None:
+        inputs.declare("img", Union[np.ndarray, torch.Tensor])
+
+    @staticmethod
+    def register_outputs(outputs: OutputParams) -> None:
+        outputs.declare("imgs", torch.Tensor)
+
+    async def forward(self) -> ComponentState:
+        batch: Optional[torch.Tensor] = None
+        for i in range(self.batch_size):
+            img = await self.inputs.img.receive()
+            img_t = img if isinstance(img, torch.Tensor) else K.image_to_tensor(img)
+            if batch is None:
+                batch = torch.empty((self.batch_size, *img_t.shape), dtype=img_t.dtype, device=img_t.device)
+            batch[i].copy_(img_t)
+
+        await self.outputs.imgs.send(batch)
         return ComponentState.OK
 
 
-class KorniaProcess(Component):
+class KorniaProcess(ThreadedComponent):
+    def __init__(self, name: str):
+        super().__init__(name)
+        self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        # the filter is bandwidth bound, use half precision on the GPU.
+        # NOTE: most CPUs have no native fp16/bf16 arithmetic, so the CPU path stays in fp32.
+        self.dtype = torch.float16 if self.device.type == "cuda" else torch.float32
+        # the sobel kernels are separable: a [1, 2, 1] smoothing and a [-1, 0, 1] derivative.
+        # stored as vertical 3x1 kernels, the horizontal ones are their transpose.
+        self._smooth = torch.tensor([1.0, 2.0, 1.0], device=self.device, dtype=self.dtype).view(1, 1, 3, 1)
+        self._deriv = torch.tensor([-1.0, 0.0, 1.0], device=self.device, dtype=self.dtype).view(1, 1, 3, 1)
+        # pinned host staging buffer to upload the host batches, allocated with the first batch
+        self._pinned = None
+
+        # fuse the normalization, the filter and the quantization. The graph is specialized on the first batch, the
+        # batch shape is fixed afterwards.
+        torch.backends.cudnn.benchmark = True
+        self._compiled_filter = torch.compile(self._filter, mode="reduce-overhead")
+
     @staticmethod
-    def register_inputs():
-        inputs = Params()
-        inputs.declare("img")
-        return inputs
+    def register_inputs(inputs: InputParams) -> None:
+        inputs.declare("imgs", torch.Tensor)
 
     @staticmethod
-    def register_outputs():
-        inputs = Params()
-        inputs.declare("img")
-        return inputs
+    def register_outputs(outputs: OutputParams) -> None:
+        outputs.declare("img", np.ndarray)
+
+    def _sobel(self, img_t: torch.Tensor) -> torch.Tensor:
+        """Same result as `K.filters.sobel(img_t, normalized=False)` with two 1d passes per gradient."""
+        b, c, h, w = img_t.shape
+        x = F.pad(img_t.reshape(b * c, 1, h, w), [1, 1, 1, 1], mode="replicate")
+        gx = F.conv2d(F.conv2d(x, self._smooth), self._deriv.transpose(-1, -2))
+        gy = F.conv2d(F.conv2d(x, self._deriv), self._smooth.transpose(-1, -2))
+        return torch.sqrt(gx * gx + gy * gy + 1e-6).reshape(b, c, h, w)
+
+    def _upload(self, imgs: torch.Tensor) -> torch.Tensor:
+        """Copy a Nx3xHxW uint8 batch to the device."""
+        if self.device.type == "cpu":
+            return imgs
+        if imgs.device.type != "cpu":
+            # already on the GPU, e.g. decoded with nvimgcodec. NOTE: `cuda:0` and `cuda` do not compare equal.
+            return imgs.to(self.device)
+        # a host batch going to the GPU is staged in pinned memory for an asynchronous upload
+        if self._pinned is None or self._pinned.shape != imgs.shape:
+            self._pinned = torch.empty(imgs.shape, dtype=torch.uint8, pin_memory=True)
+        # NOTE: reusing the staging buffer is safe since `_process` syncs with the device before returning
+        self._pinned.copy_(imgs)
+        return self._pinned.to(self.device, non_blocking=True)
+
+    def _filter(self, imgs: torch.Tensor) -> torch.Tensor:
+        """Sobel magnitude of a Nx3xHxW uint8 batch, quantized back to uint8."""
+        img_t = imgs.to(self.dtype).div_(255.0)
+        img_t = self._sobel(img_t)
+
+        # quantize on the device, as cv2.imshow does with the [0, 1] float images, to pull back less data
+        return img_t.clamp_(0.0, 1.0).mul_(255.0).round_().to(torch.uint8)
+
+    def _process(self, imgs: torch.Tensor) -> np.ndarray:
+        img_t = self._compiled_filter(self._upload(imgs))
 
-    async def forward(self):
-        img = self.inputs.get_param("img")
+        # pull back to the host for the visualization as a NxHxWx3 array
+        return K.tensor_to_image(img_t, keepdim=True)
 
-        img_t = K.image_to_tensor(img)
-        img_t = img_t[None].float() / 255.0
-        img_t = K.filters.sobel(img_t, normalized=False)
+    async def forward(self) -> ComponentState:
+        imgs: torch.Tensor = await self.inputs.imgs.receive()
 
-        img = K.tensor_to_image(img_t)
-        self.outputs.set_param("img", img)
+        img: np.ndarray = await self.run_in_executor(self._process, imgs)
+        await self.outputs.img.send(img)
 
         return ComponentState.OK
 
 
 async def main():
+    # NOTE: the frames stream connects to the camera service with the first `forward`
     cam = AmigaCamera("oak1")
-    await cam.client.connect_to_service()
 
     viz1 = OpencvWindow("viz_raw")
     viz2 = OpencvWindow("viz_img")
 
+    # run the sobel filter on batches of frames
+    batch = BatchAccumulator("batch", batch_size=8)
     imgproc = KorniaProcess("imgproc")
 
     cam.outputs.img >> viz1.inputs.img
-    cam.outputs.img >> imgproc.inputs.img
+    cam.outputs.img >> batch.inputs.img
+    batch.outputs.imgs >> imgproc.inputs.imgs
     imgproc.outputs.img >> viz2.inputs.img
 
     pipeline = Pipeline()
-    # NOTE: in future not needed
-    pipeline.add_nodes([cam, viz1, viz2, imgproc])
+    pipeline.add_nodes([cam, viz1, viz2, batch, imgproc])
 
     # run your pipeline
-    # NOTE: in future not needed
-    pipeline.traverse()
-    await pipeline.async_execute()
+    await pipeline.async_run()
 
 
 if __name__ == "__main__":
+    # use the libuv based event loop
+    uvloop.install()
     asyncio.run(main())
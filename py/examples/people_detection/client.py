@@ -11,7 +11,10 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import asyncio
 from typing import List
+from typing import Optional
+from typing import Tuple
 
 import numpy as np
 from farm_ng.people_detection import people_detection_pb2
@@ -20,6 +23,15 @@ from farm_ng.service.service_client import ClientConfig
 from farm_ng.service.service_client import ServiceClient
 
 
+def _image_to_proto(image: np.ndarray) -> people_detection_pb2.Image:
+    return people_detection_pb2.Image(
+        data=image.tobytes(),
+        size=people_detection_pb2.ImageSize(width=image.shape[1], height=image.shape[0]),
+        num_channels=image.shape[2],
+        dtype="uint8",
+    )
+
+
 class PeopleDetectorClient(ServiceClient):
     def __init__(self, config: ClientConfig) -> None:
         super().__init__(config)
@@ -30,12 +42,82 @@ class PeopleDetectorClient(ServiceClient):
         response = await self.stub.detectPeople(
             people_detection_pb2.DetectPeopleRequest(
                 config=people_detection_pb2.DetectPeopleConfig(confidence_threshold=score_threshold),
-                image=people_detection_pb2.Image(
-                    data=image.tobytes(),
-                    size=people_detection_pb2.ImageSize(width=image.shape[1], height=image.shape[0]),
-                    num_channels=image.shape[2],
-                    dtype="uint8",
-                ),
+                image=_image_to_proto(image),
             )
         )
         return list(response.detections)
+
+    async def detect_people_batch(
+        self, images: List[np.ndarray], score_threshold: float
+    ) -> List[List[people_detection_pb2.Detection]]:
+        response = await self.stub.detectPeopleBatch(
+            people_detection_pb2.DetectPeopleBatchRequest(
+                config=people_detection_pb2.DetectPeopleConfig(confidence_threshold=score_threshold),
+                images=[_image_to_proto(image) for image in images],
+            )
+        )
+        return [list(reply.detections) for reply in response.replies]
+
+
+class AsyncBatcher:
+    """Coalesce concurrent detection requests into batched requests.
+
+    A batch is sent when it has `max_batch_size` images or `timeout_s` seconds after its first image arrived.
+    Requires a service implementing `detectPeopleBatch`.
+
+    Args:
+        client (PeopleDetectorClient): the client to send the batches with.
+        score_threshold (float): the confidence threshold for the detections.
+        max_batch_size (int): the maximum number of images per request.
+        timeout_s (float): the maximum time to wait to fill a batch.
+    """
+
+    def __init__(
+        self, client: PeopleDetectorClient, score_threshold: float, max_batch_size: int = 8, timeout_s: float = 0.05
+    ) -> None:
+        self.client = client
+        self.score_threshold = score_threshold
+        self.max_batch_size = max_batch_size
+        self.timeout_s = timeout_s
+
+        self._queue: "asyncio.Queue[Tuple[np.ndarray, asyncio.Future]]" = asyncio.Queue()
+        self._worker: Optional[asyncio.Task] = None
+
+    async def submit(self, image: np.ndarray) -> List[people_detection_pb2.Detection]:
+        """Queue an image and wait for its detections."""
+        if self._worker is None:
+            self._worker = asyncio.create_task(self._run())
+        future: asyncio.Future = asyncio.get_running_loop().create_future()
+        await self._queue.put((image, future))
+        return await future
+
+    async def _next_batch(self) -> List[Tuple[np.ndarray, asyncio.Future]]:
+        loop = asyncio.get_running_loop()
+        batch = [await self._queue.get()]
+        deadline: float = loop.time() + self.timeout_s
+        while len(batch) < self.max_batch_size:
+            timeout: float = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self) -> None:
+        while True:
+            batch = await self._next_batch()
+            images = [image for image, _ in batch]
+            try:
+                results = await self.client.detect_people_batch(images, self.score_threshold)
+                if len(results) != len(batch):
+                    raise RuntimeError(f"Expected detections for {len(batch)} images, got {len(results)}.")
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (_, future), detections in zip(batch, results):
+                if not future.done():
+                    future.set_result(detections)
@@ -1,11 +1,19 @@
 import argparse
 import asyncio
+from collections import deque
+from typing import Any
+from typing import Deque
 from typing import List
+from typing import Optional
+from typing import Tuple
+from typing import Union
 
 import cv2
+import grpc
 import numpy as np
+import uvloop
+from client import AsyncBatcher
 from client import PeopleDetectorClient
-from farm_ng.oak import oak_pb2
 from farm_ng.oak.camera_client import OakCameraClient
 from farm_ng.people_detection import people_detection_pb2
 from farm_ng.service.service_client import ClientConfig
@@ -14,36 +22,116 @@ from limbus.core import ComponentState
 from limbus.core import InputParams
 from limbus.core import OutputParams
 from limbus.core.pipeline import Pipeline
+from turbojpeg import TJPF_BGR
+from turbojpeg import TurboJPEG
 
 
 class AmigaCamera(Component):
-    def __init__(self, name: str, config: ClientConfig, stream_every_n: int) -> None:
+    # decode the jpeg frames at 5/8 of their resolution, the closest libjpeg-turbo scaling factor to 60%
+    SCALING_FACTOR = (5, 8)
+
+    def __init__(
+        self, name: str, config: ClientConfig, stream_every_n: int, num_buffers: int = 2, threaded_stream: bool = True
+    ) -> None:
         super().__init__(name)
         # configure the camera client
         self.client = OakCameraClient(config)
-        # create a stream
-        self.stream = self.client.stream_frames(every_n=stream_every_n)
+        # create a stream. The threaded stream reads the frames off the event loop, the async stream is the fallback.
+        if threaded_stream:
+            self.stream = self.client.stream_frames_threaded(every_n=stream_every_n)
+        else:
+            self.stream = self.client.stream_frames(every_n=stream_every_n)
+        # the most recent frame of the stream: when the pipeline is slower than the camera the older frames are
+        # dropped instead of queueing up, which keeps the latency bounded.
+        # the stream errors and its end (grpc.aio.EOF) go through the same slot.
+        self._latest_frame: "asyncio.Queue[Any]" = asyncio.Queue(maxsize=1)
+        self._reader: Optional[asyncio.Task] = None
+
+        # jpeg decoder and preallocated frame buffers, reused across frames.
+        # NOTE: the image sent downstream aliases one of these buffers. `num_buffers` must cover the frames
+        # held downstream plus the one being decoded.
+        self._jpeg = TurboJPEG()
+        self._num_buffers = num_buffers
+        self._frame_bufs: List[np.ndarray] = []
+        self._frame_idx: int = 0
 
     @staticmethod
     def register_outputs(outputs: OutputParams) -> None:
         outputs.declare("image", np.ndarray)
 
-    def _decode_image(self, image_data: bytes) -> np.ndarray:
-        image: np.ndarray = np.frombuffer(image_data, dtype="uint8")
-        image = cv2.imdecode(image, cv2.IMREAD_UNCHANGED)
-        scale_percent =60
-        width = int(image.shape[1]*scale_percent/100)
-        height = int(image.shape[0]*scale_percent/100)
-        dim = (width,height)
+    def _next_frame_buf(self, image_data: Union[bytes, memoryview]) -> np.ndarray:
+        width, height, _, _ = self._jpeg.decode_header(image_data)
+        num, denom = self.SCALING_FACTOR
+        # same rounding as libjpeg-turbo TJSCALED
+        shape = ((height * num + denom - 1) // denom, (width * num + denom - 1) // denom, 3)
+        if not self._frame_bufs or self._frame_bufs[0].shape != shape:
+            self._frame_bufs = [np.empty(shape, dtype=np.uint8) for _ in range(self._num_buffers)]
+        self._frame_idx = (self._frame_idx + 1) % len(self._frame_bufs)
+        return self._frame_bufs[self._frame_idx]
+
+    def _decode_image(self, image_data: Union[bytes, memoryview]) -> np.ndarray:
+        """Decode the jpeg image. CPU only, it does not touch the event loop and runs in a worker thread."""
+        # NOTE: the image is downscaled inside the IDCT, the detections are given in the scaled resolution.
+        return self._jpeg.decode(
+            image_data,
+            pixel_format=TJPF_BGR,
+            scaling_factor=self.SCALING_FACTOR,
+            dst=self._next_frame_buf(image_data),
+        )
 
-        image = cv2.resize(image,dim)
-        return image
+    def _put_latest(self, item: Any) -> None:
+        if self._latest_frame.full():
+            self._latest_frame.get_nowait()
+        self._latest_frame.put_nowait(item)
+
+    async def _read_stream(self) -> None:
+        try:
+            while True:
+                response = await self.stream.read()
+                if response is grpc.aio.EOF:
+                    # let `forward` stop the component at the end of the stream
+                    self._put_latest(grpc.aio.EOF)
+                    return
+                self._put_latest(response.frame)
+        except Exception as e:
+            # hand the stream errors to `forward`, which may already be waiting for the next frame
+            self._put_latest(e)
+
+    def _stop_stream(self) -> None:
+        if self._reader is not None:
+            self._reader.cancel()
+        if self.stream is not None:
+            self.stream.cancel()
 
     async def forward(self) -> ComponentState:
-        response = await self.stream.read()
-        frame: oak_pb2.OakSyncFrame = response.frame
+        try:
+            state: ComponentState = await self._forward()
+        except BaseException:
+            # stop the stream when the camera fails or the pipeline is cancelled, the threaded stream keeps
+            # reading otherwise
+            self._stop_stream()
+            raise
+        if state == ComponentState.STOPPED:
+            self._stop_stream()
+        return state
+
+    async def _forward(self) -> ComponentState:
+        if self._reader is None:
+            self._reader = asyncio.create_task(self._read_stream())
+
+        frame = await self._latest_frame.get()
+        if isinstance(frame, Exception):
+            # propagate the stream errors
+            raise frame
+        if frame is grpc.aio.EOF:
+            return ComponentState.STOPPED
+
+        # decode in a worker thread so that the event loop keeps serving the other components
+        image: np.ndarray = await asyncio.get_running_loop().run_in_executor(
+            None, self._decode_image, memoryview(frame.rgb.image_data)
+        )
 
-        await self.outputs.image.send(self._decode_image(frame.rgb.image_data))
+        await self.outputs.image.send(image)
 
         return ComponentState.OK
 
@@ -69,10 +157,30 @@ class OpenCvCamera(Component):
 
 
 class PeopleDetector(Component):
-    def __init__(self, name: str, config: ClientConfig, confidence_threshold: float) -> None:
+    """Detect people with up to `num_workers` requests in flight to the detection service.
+
+    The detections are sent in the same order as the images were received, together with their image.
+    With `batch_size` > 1 the concurrent requests are coalesced into batches, this requires a service
+    implementing `detectPeopleBatch`.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        config: ClientConfig,
+        confidence_threshold: float,
+        num_workers: int = 2,
+        batch_size: int = 1,
+    ) -> None:
         super().__init__(name)
         self.confidence_threshold = confidence_threshold
+        self.num_workers = num_workers
         self.detector_client = PeopleDetectorClient(config)
+        self._batcher: Optional[AsyncBatcher] = None
+        if batch_size > 1:
+            self._batcher = AsyncBatcher(self.detector_client, confidence_threshold, max_batch_size=batch_size)
+        # the images with their pending requests, in arrival order
+        self._in_flight: Deque[Tuple[np.ndarray, asyncio.Task]] = deque()
 
     @staticmethod
     def register_inputs(inputs: InputParams) -> None:
@@ -80,23 +188,49 @@ class PeopleDetector(Component):
 
     @staticmethod
     def register_outputs(outputs: OutputParams) -> None:
+        outputs.declare("image", np.ndarray)
         outputs.declare("detections", List[people_detection_pb2.Detection])
 
+    async def _cancel_in_flight(self) -> None:
+        """Cancel the pending requests and wait for them, so that no request is left running."""
+        requests = [request for _, request in self._in_flight]
+        self._in_flight.clear()
+        for request in requests:
+            request.cancel()
+        await asyncio.gather(*requests, return_exceptions=True)
+
     async def forward(self) -> ComponentState:
         # get the image
         image: np.ndarray = await self.inputs.image.receive()
 
-        # send data to the server
-        detections: List[people_detection_pb2.Detection] = await self.detector_client.detect_people(
-            image, self.confidence_threshold
-        )
-
-        # send the detections
-        await self.outputs.detections.send(detections)
+        # send data to the server without waiting for the reply
+        if self._batcher is not None:
+            request = asyncio.create_task(self._batcher.submit(image))
+        else:
+            request = asyncio.create_task(self.detector_client.detect_people(image, self.confidence_threshold))
+        self._in_flight.append((image, request))
+        if len(self._in_flight) < self.num_workers:
+            return ComponentState.OK
+
+        # wait for the oldest request
+        image, request = self._in_flight.popleft()
+        try:
+            detections: List[people_detection_pb2.Detection] = await request
+        except BaseException:
+            await self._cancel_in_flight()
+            raise
+
+        # send the detections with their image
+        await asyncio.gather(self.outputs.image.send(image), self.outputs.detections.send(detections))
         return ComponentState.OK
 
 
 class Visualization(Component):
+    def __init__(self, name: str) -> None:
+        super().__init__(name)
+        cv2.namedWindow("image", cv2.WINDOW_NORMAL)
+        cv2.resizeWindow("image", 1280, 800)
+
     @staticmethod
     def register_inputs(inputs: InputParams) -> None:
         inputs.declare("image", np.ndarray)
@@ -104,27 +238,43 @@ class Visualization(Component):
 
     async def forward(self) -> ComponentState:
         image, detections = await asyncio.gather(self.inputs.image.receive(), self.inputs.detections.receive())
-        image_vis = image.copy()
-        for det in detections:
-            image_vis = cv2.rectangle(
-                image_vis, (int(det.x), int(det.y)), (int(det.x + det.width), int(det.y + det.height)), (0, 255, 0), 2
-            )
-
-        cv2.namedWindow("image", cv2.WINDOW_NORMAL)
-        cv2.resizeWindow('image', 1280, 800)
-        cv2.imshow("image", image_vis)
+        # NOTE: draw directly on the received image, the visualization is its last consumer
+        if detections:
+            # draw all the boxes with a single call, as Nx4x2 corner arrays
+            boxes = np.array([(det.x, det.y, det.x + det.width, det.y + det.height) for det in detections])
+            corners = boxes.astype(np.int32)[:, [[0, 1], [2, 1], [2, 3], [0, 3]]]
+            cv2.polylines(image, corners, isClosed=True, color=(0, 255, 0), thickness=2)
+
+        cv2.imshow("image", image)
         cv2.waitKey(1)
+        return ComponentState.OK
 
-async def main(config_camera: ClientConfig, config_detector: ClientConfig) -> None:
 
-    cam = AmigaCamera("amiga-camera", config_camera, stream_every_n=config_camera.stream_every_n)
+async def main(
+    config_camera: ClientConfig,
+    config_detector: ClientConfig,
+    num_workers: int,
+    batch_size: int,
+    threaded_stream: bool = True,
+) -> None:
+
+    # the detector holds `num_workers` frames, plus one in the visualization and one being decoded
+    cam = AmigaCamera(
+        "amiga-camera",
+        config_camera,
+        stream_every_n=config_camera.stream_every_n,
+        num_buffers=num_workers + 2,
+        threaded_stream=threaded_stream,
+    )
     # NOTE: use the OpenCvCamera if you want to use a webcam
     # cam = OpenCvCamera("opencv-camera")
-    detector = PeopleDetector("people-detector", config_detector, confidence_threshold=0.5)
+    detector = PeopleDetector(
+        "people-detector", config_detector, confidence_threshold=0.5, num_workers=num_workers, batch_size=batch_size
+    )
     viz = Visualization("visualization")
 
     cam.outputs.image >> detector.inputs.image
-    cam.outputs.image >> viz.inputs.image
+    detector.outputs.image >> viz.inputs.image
     detector.outputs.detections >> viz.inputs.detections
 
     pipeline = Pipeline()
@@ -140,6 +290,13 @@ if __name__ == "__main__":
     parser.add_argument("--port-detector", type=int, required=True, help="The camera port.")
     parser.add_argument("--address-detector", type=str, default="localhost", help="The camera address")
     parser.add_argument("--stream-every-n", type=int, default=5, help="Streaming frequency")
+    parser.add_argument("--num-workers", type=int, default=2, help="Number of detection requests in flight")
+    parser.add_argument(
+        "--batch-size", type=int, default=1, help="Max images per detection request, needs a batch capable service"
+    )
+    parser.add_argument(
+        "--async-stream", action="store_true", help="Read the camera stream on the event loop instead of a thread"
+    )
     args = parser.parse_args()
 
     # create the config for the clients
@@ -148,5 +305,8 @@ if __name__ == "__main__":
 
     config_detector = ClientConfig(port=args.port_detector, address=args.address_detector)
 
-    # run the main
-    asyncio.run(main(config_camera, config_detector))
+    # run the main with the libuv based event loop
+    uvloop.install()
+    asyncio.run(
+        main(config_camera, config_detector, args.num_workers, args.batch_size, threaded_stream=not args.async_stream)
+    )
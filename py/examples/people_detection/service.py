@@ -15,6 +15,7 @@ import argparse
 import asyncio
 import logging
 from pathlib import Path
+from typing import List
 
 import cv2
 import grpc
@@ -35,12 +36,41 @@ class PeopleDetectionService(people_detection_pb2_grpc.PeopleDetectionServiceSer
         )
         logger.info("Loaded model: %s", models_dir.absolute())
 
+    @staticmethod
+    def _decode_image(image: people_detection_pb2.Image) -> np.ndarray:
+        data: np.ndarray = np.frombuffer(image.data, dtype=image.dtype)
+        return np.reshape(data, (image.size.height, image.size.width, image.num_channels))
+
+    @staticmethod
+    def _make_reply(
+        detections: np.ndarray, size: people_detection_pb2.ImageSize, config: people_detection_pb2.DetectPeopleConfig
+    ) -> people_detection_pb2.DetectPeopleReply:
+        # detections is a Nx7 array: [batch_id, class_id, confidence, x_min, y_min, x_max, y_max]
+        response = people_detection_pb2.DetectPeopleReply()
+
+        for i in range(detections.shape[0]):
+            class_id = int(detections[i, 1])
+            if class_id != 1:  # 1 is the class id for person
+                continue
+            confidence: float = detections[i, 2]
+            if confidence > config.confidence_threshold:
+                x = int(detections[i, 3] * size.width)
+                y = int(detections[i, 4] * size.height)
+                w = int(detections[i, 5] * size.width) - x
+                h = int(detections[i, 6] * size.height) - y
+                response.detections.append(
+                    people_detection_pb2.Detection(x=x, y=y, width=w, height=h, confidence=confidence)
+                )
+
+        logger.debug("Num detections filtered %d", len(response.detections))
+
+        return response
+
     async def detectPeople(
         self, request: people_detection_pb2.DetectPeopleRequest, context: grpc.aio.ServicerContext
     ) -> people_detection_pb2.DetectPeopleReply:
         # decode the image
-        image: np.ndarray = np.frombuffer(request.image.data, dtype=request.image.dtype)
-        image = np.reshape(image, (request.image.size.height, request.image.size.width, request.image.num_channels))
+        image: np.ndarray = self._decode_image(request.image)
 
         logger.debug("Detecting people in image of size %s", image.shape)
 
@@ -51,23 +81,24 @@ class PeopleDetectionService(people_detection_pb2_grpc.PeopleDetectionServiceSer
         logger.debug("Num detections %d", detections.shape[2])
 
         # create the reply
-        response = people_detection_pb2.DetectPeopleReply()
+        return self._make_reply(detections[0, 0], request.image.size, request.config)
 
-        for i in range(detections.shape[2]):
-            class_id = int(detections[0, 0, i, 1])
-            if class_id != 1:  # 1 is the class id for person
-                continue
-            confidence: float = detections[0, 0, i, 2]
-            if confidence > request.config.confidence_threshold:
-                x = int(detections[0, 0, i, 3] * request.image.size.width)
-                y = int(detections[0, 0, i, 4] * request.image.size.height)
-                w = int(detections[0, 0, i, 5] * request.image.size.width) - x
-                h = int(detections[0, 0, i, 6] * request.image.size.height) - y
-                response.detections.append(
-                    people_detection_pb2.Detection(x=x, y=y, width=w, height=h, confidence=confidence)
-                )
+    async def detectPeopleBatch(
+        self, request: people_detection_pb2.DetectPeopleBatchRequest, context: grpc.aio.ServicerContext
+    ) -> people_detection_pb2.DetectPeopleBatchReply:
+        # decode the images
+        images: List[np.ndarray] = [self._decode_image(image) for image in request.images]
 
-        logger.debug("Num detections filtered %d", len(response.detections))
+        logger.debug("Detecting people in a batch of %d images", len(images))
+
+        # detect people, a single forward pass for the whole batch
+        self.model.setInput(cv2.dnn.blobFromImages(images, size=(300, 300), swapRB=True))
+        detections = self.model.forward()[0, 0]
+
+        # create the reply, the first column of the detections is the index of the image in the batch
+        response = people_detection_pb2.DetectPeopleBatchReply()
+        for i, image in enumerate(request.images):
+            response.replies.append(self._make_reply(detections[detections[:, 0] == i], image.size, request.config))
 
         return response
 
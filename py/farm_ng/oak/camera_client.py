@@ -12,53 +12,169 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import asyncio
+import functools
 import logging
+import threading
 import time
+import types
+from typing import Any
+from typing import Callable
+from typing import Optional
 
+import grpc
 from farm_ng.oak import oak_pb2
 from farm_ng.oak import oak_pb2_grpc
 from farm_ng.service.service_client import ClientConfig
 from farm_ng.service.service_client import ServiceClient
 
-__all__ = ["OakCameraClient"]
+__all__ = ["OakCameraClient", "FrameStreamThread"]
 
 logging.basicConfig(level=logging.INFO)
 
 
+class _RateLimiterState:
+    """Per instance state of a rate limited method."""
+
+    def __init__(self) -> None:
+        self.last_call: Optional[float] = None
+        self.pending: Optional[functools.partial] = None
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+
+
 class RateLimiter:
-    def __init__(self, period):
-        self.last_call = None
+    """Method descriptor that executes the wrapped method at most once per period.
+
+    A call within the period is deferred until the period expires. Only the most recent deferred call is
+    executed. The state is kept per instance, so different clients do not limit each other.
+
+    Args:
+        func (Callable): the method to rate limit.
+        period (float): the minimum time in seconds between two calls.
+    """
+
+    def __init__(self, func: Callable, period: float) -> None:
+        functools.update_wrapper(self, func)
+        self.func = func
         self.period = period
-        self.outstanding_call = False
-        self.args = None
-        self.kargs = None
-
-    def wrapper(self, func):
-        self.last_call = time.monotonic()
-        self.outstanding_call = False
-        func(*self.args, **self.kargs)
-
-    def __call__(self, func):
-        """Return a wrapped function that can only be called once per frequency where the most recent call will be
-        executed."""
-
-        def async_wrapper(*args, **kargs):
-            self.args = args
-            self.kargs = kargs
-            delay = self.next_call_wait()
-            if delay < 0:
-                self.wrapper(func)
-            else:
-                if not self.outstanding_call:
-                    asyncio.get_running_loop().call_later(delay, self.wrapper, func)
-                    self.outstanding_call = True
-
-        return async_wrapper
-
-    def next_call_wait(self):
-        if self.last_call is None:
-            return -1
-        return self.period - (time.monotonic() - self.last_call)
+        self._state_name = f"_{func.__name__}_rate_limiter"
+
+    def __get__(self, obj: Any, objtype: Any = None) -> Any:
+        if obj is None:
+            return self
+        return types.MethodType(self, obj)
+
+    def __call__(self, obj: Any, *args, **kwargs) -> None:
+        state: Optional[_RateLimiterState] = obj.__dict__.get(self._state_name)
+        if state is None:
+            state = obj.__dict__[self._state_name] = _RateLimiterState()
+
+        now = time.monotonic()
+        if state.pending is None and (state.last_call is None or now - state.last_call >= self.period):
+            state.last_call = now
+            self.func(obj, *args, **kwargs)
+            return
+
+        if state.pending is None:
+            if state.loop is None:
+                state.loop = asyncio.get_running_loop()
+            state.loop.call_later(self.period - (now - state.last_call), self._call_pending, state)
+        # keep only the most recent call
+        state.pending = functools.partial(self.func, obj, *args, **kwargs)
+
+    @staticmethod
+    def _call_pending(state: _RateLimiterState) -> None:
+        call, state.pending = state.pending, None
+        state.last_call = time.monotonic()
+        call()
+
+
+def ratelimited(period: float) -> Callable[[Callable], RateLimiter]:
+    """Decorator to rate limit a method. See `RateLimiter`.
+
+    Args:
+        period (float): the minimum time in seconds between two calls.
+    """
+
+    def decorator(func: Callable) -> RateLimiter:
+        return RateLimiter(func, period)
+
+    return decorator
+
+
+class FrameStreamThread:
+    """Frames stream read by a dedicated thread over a blocking grpc channel.
+
+    The network reads do not depend on how busy the asyncio event loop is. Only the most recent reply is
+    kept: `read` returns the newest reply not read yet, the older ones are dropped.
+
+    Args:
+        server_address (str): the composed address and port of the camera service.
+        every_n (int): the streaming frequency. In practice, drops `n` frames.
+        options (list): the grpc channel arguments.
+    """
+
+    def __init__(self, server_address: str, every_n: int, options: Optional[list] = None) -> None:
+        self._channel = grpc.insecure_channel(server_address, options=options)
+        self._stub = oak_pb2_grpc.OakServiceStub(self._channel)
+        self._every_n = every_n
+        self._call = None
+
+        # the latest reply and the end of stream state, shared with the reader thread
+        self._lock = threading.Lock()
+        self._latest: Optional[oak_pb2.StreamFramesReply] = None
+        self._error: Optional[Exception] = None
+        self._done = False
+
+        # created with the first `read`, to bind to the running loop
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._event: Optional[asyncio.Event] = None
+        self._thread = threading.Thread(target=self._run, name="oak_frames_stream", daemon=True)
+
+    def _run(self) -> None:
+        try:
+            self._call = self._stub.streamFrames(oak_pb2.StreamFramesRequest(every_n=self._every_n))
+            for reply in self._call:
+                with self._lock:
+                    self._latest = reply
+                self._wake()
+        except Exception as e:
+            # any failure is raised by `read`, only a completed stream ends with grpc.aio.EOF
+            self._error = e
+        finally:
+            self._done = True
+            self._wake()
+
+    def _wake(self) -> None:
+        try:
+            self._loop.call_soon_threadsafe(self._event.set)
+        except RuntimeError:
+            # the loop is closed when the stream outlives the pipeline
+            pass
+
+    async def read(self):
+        """Return the most recent oak_pb2.StreamFramesReply, or grpc.aio.EOF at the end of the stream."""
+        if self._event is None:
+            self._loop = asyncio.get_running_loop()
+            self._event = asyncio.Event()
+            self._thread.start()
+
+        while True:
+            with self._lock:
+                reply, self._latest = self._latest, None
+            if reply is not None:
+                return reply
+            if self._error is not None:
+                raise self._error
+            if self._done:
+                return grpc.aio.EOF
+            await self._event.wait()
+            self._event.clear()
+
+    def cancel(self) -> None:
+        """Stop the stream and close the channel."""
+        if self._call is not None:
+            self._call.cancel()
+        self._channel.close()
 
 
 class OakCameraClient(ServiceClient):
@@ -71,6 +187,14 @@ class OakCameraClient(ServiceClient):
         config (ClientConfig): the grpc configuration data structure.
     """
 
+    CHANNEL_OPTIONS = [
+        # a sync frame carries several jpeg images, above the 4MB grpc default
+        ("grpc.max_receive_message_length", 32 << 20),
+        # keep the long lived frames stream alive without pinging the server too often
+        ("grpc.keepalive_time_ms", 30000),
+        ("grpc.http2.min_time_between_pings_ms", 10000),
+    ]
+
     def __init__(self, config: ClientConfig) -> None:
         super().__init__(config)
 
@@ -110,12 +234,12 @@ class OakCameraClient(ServiceClient):
         """
         return await self.stub.getCalibration(oak_pb2.GetCalibrationRequest())
 
-    @RateLimiter(period=1)
+    @ratelimited(period=1)
     def update_rgb_settings(self, rgb_settings):
         self.needs_update = True
         self._rgb_camera_settings = rgb_settings
 
-    @RateLimiter(period=1)
+    @ratelimited(period=1)
     def update_mono_settings(self, mono_settings):
         self.needs_update = True
         self._mono_camera_settings = mono_settings
@@ -127,3 +251,11 @@ class OakCameraClient(ServiceClient):
             every_n: the streaming frequency. In practice, drops `n` frames.
         """
         return self.stub.streamFrames(oak_pb2.StreamFramesRequest(every_n=every_n))
+
+    def stream_frames_threaded(self, every_n: int) -> FrameStreamThread:
+        """Return a streaming object read by a dedicated thread, with the same `read` as `stream_frames`.
+
+        Args:
+            every_n: the streaming frequency. In practice, drops `n` frames.
+        """
+        return FrameStreamThread(self.server_address, every_n, options=self.CHANNEL_OPTIONS)
@@ -13,6 +13,9 @@
 # limitations under the License.
 import logging
 from dataclasses import dataclass
+from typing import Any
+from typing import List
+from typing import Tuple
 
 import grpc
 from farm_ng.service import service_pb2
@@ -76,6 +79,9 @@ class ServiceClient:
         config (ClientConfig): the grpc configuration data structure.
     """
 
+    # the grpc channel arguments, overridden by the service specific clients
+    CHANNEL_OPTIONS: List[Tuple[str, Any]] = []
+
     def __init__(self, config: ClientConfig) -> None:
         print('config in ServiceClient', config)
         self.config = config
@@ -83,7 +89,7 @@ class ServiceClient:
         self.logger = logging.getLogger(self.__class__.__name__)
 
         # create an async connection with the server
-        self.channel = grpc.aio.insecure_channel(self.server_address)
+        self.channel = grpc.aio.insecure_channel(self.server_address, options=self.CHANNEL_OPTIONS)
         self.state_stub = service_pb2_grpc.ServiceBaseStub(self.channel)
 
     @property
@@ -11,13 +11,56 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import asyncio
+from typing import Iterator
+from typing import List
+from typing import Optional
+
+import grpc
 import pytest
+from farm_ng.oak import oak_pb2
 from farm_ng.oak.camera_client import OakCameraClient
+from farm_ng.oak.camera_client import ratelimited
 from farm_ng.service import service_pb2
 from farm_ng.service.service_client import ClientConfig
 from farm_ng.service.service_client import ServiceState
 
 
+class _Settings:
+    def __init__(self) -> None:
+        self.values: List[int] = []
+
+    @ratelimited(period=0.05)
+    def update(self, value: int) -> None:
+        self.values.append(value)
+
+
+class _FakeStreamFramesCall:
+    """Blocking streamFrames call replying with `num_frames` frames, then failing with `error` if set."""
+
+    def __init__(self, num_frames: int, error: Optional[Exception] = None) -> None:
+        self.num_frames = num_frames
+        self.error = error
+        self.cancelled = False
+
+    def __iter__(self) -> Iterator[oak_pb2.StreamFramesReply]:
+        for i in range(self.num_frames):
+            yield oak_pb2.StreamFramesReply(frame=oak_pb2.OakSyncFrame(sequence_num=i))
+        if self.error is not None:
+            raise self.error
+
+    def cancel(self) -> None:
+        self.cancelled = True
+
+
+class _FakeOakStub:
+    def __init__(self, call: _FakeStreamFramesCall) -> None:
+        self.call = call
+
+    def streamFrames(self, request: oak_pb2.StreamFramesRequest) -> _FakeStreamFramesCall:
+        return self.call
+
+
 @pytest.fixture(name="config")
 def fixture_config() -> ClientConfig:
     return ClientConfig(port=50051)
@@ -38,3 +81,64 @@ class TestOakClient:
         client = OakCameraClient(config)
         state: ServiceState = await client.get_state()
         assert state.value == service_pb2.ServiceState.UNAVAILABLE
+
+    @pytest.mark.asyncio
+    async def test_stream_frames_threaded_unavailable(self, config: ClientConfig) -> None:
+        client = OakCameraClient(config)
+        stream = client.stream_frames_threaded(every_n=1)
+        # the error of the reader thread is raised by `read`
+        with pytest.raises(grpc.RpcError):
+            await stream.read()
+        stream.cancel()
+
+    @pytest.mark.asyncio
+    async def test_stream_frames_threaded_eof(self, config: ClientConfig) -> None:
+        client = OakCameraClient(config)
+        stream = client.stream_frames_threaded(every_n=1)
+        call = _FakeStreamFramesCall(num_frames=3)
+        stream._stub = _FakeOakStub(call)
+        sequence_nums: List[int] = []
+        while True:
+            reply = await stream.read()
+            if reply is grpc.aio.EOF:
+                break
+            sequence_nums.append(reply.frame.sequence_num)
+        # the older replies may be dropped, the frames come in order and the last one is always handed over
+        assert sequence_nums == sorted(set(sequence_nums))
+        assert sequence_nums[-1] == 2
+        # the end of the stream is sticky
+        assert await stream.read() is grpc.aio.EOF
+        stream.cancel()
+        assert call.cancelled
+
+    @pytest.mark.asyncio
+    async def test_stream_frames_threaded_error(self, config: ClientConfig) -> None:
+        client = OakCameraClient(config)
+        stream = client.stream_frames_threaded(every_n=1)
+        stream._stub = _FakeOakStub(_FakeStreamFramesCall(num_frames=0, error=ValueError("boom")))
+        # any error of the reader thread is raised by `read`, not reported as the end of the stream
+        with pytest.raises(ValueError):
+            await stream.read()
+        stream.cancel()
+
+
+class TestRateLimiter:
+    @pytest.mark.asyncio
+    async def test_most_recent_call(self) -> None:
+        settings = _Settings()
+        settings.update(1)
+        settings.update(2)
+        settings.update(3)
+        # the first call runs right away, the last one is deferred until the period expires
+        assert settings.values == [1]
+        await asyncio.sleep(0.1)
+        assert settings.values == [1, 3]
+
+    @pytest.mark.asyncio
+    async def test_per_instance(self) -> None:
+        settings_a = _Settings()
+        settings_b = _Settings()
+        settings_a.update(1)
+        settings_b.update(2)
+        assert settings_a.values == [1]
+        assert settings_b.values == [2]